@@ -1,8 +1,10 @@
 import streamlit as st
 import re
-import pandas as pd
+import io
+import time
+from collections import OrderedDict
 import json # For handling JSON data from URL
-import requests # For making HTTP requests
+import http.cookiejar
 
 # --- Predefined list of allowed variables ---
 # Note: {{student_answer}} is special and comes from the Answers input section.
@@ -15,6 +17,158 @@ PREDEFINED_VARIABLES = [
     "can_do_statements"
 ]
 ALL_POSSIBLE_VARIABLES = PREDEFINED_VARIABLES + ["student_answer"]
+ALLOWED_VARIABLES = frozenset(ALL_POSSIBLE_VARIABLES) # For set operations on template variables
+
+# Maximum number of generated prompts rendered in the results table
+PREVIEW_ROW_LIMIT = 50
+
+# Per-session cache of downloaded content (see fetch_and_populate_variables_action)
+FETCH_CACHE_MAX_ENTRIES = 8 # Least recently used URLs are evicted beyond this
+FETCH_CACHE_TTL_SECONDS = 60 # Bodies without ETag/Last-Modified are re-downloaded after this
+
+# --- Precompiled template patterns ---
+# Matches any {{placeholder}}; only used to warn about unknown variables.
+# A bounded character class instead of a lazy (.*?) avoids backtracking between placeholders.
+# It allows empty names (so {{}} is still reported) and, like (.*?), never spans lines.
+_PLACEHOLDER_RE = re.compile(r"\{\{([^{}\n]*)\}\}")
+# Matches only the allowed {{placeholders}}, so substitution leaves unknown ones untouched.
+_VAR_RE = re.compile(r"\{\{(" + "|".join(map(re.escape, ALL_POSSIBLE_VARIABLES)) + r")\}\}")
+# Sentinel marking the {{student_answer}} slots in a pre-filled template
+_STUDENT_ANSWER_SLOT = object()
+
+
+# --- Template helpers ---
+def _compile_template(template):
+    """
+    Splits the template once into (literal, None) and (None, variable_name) tokens.
+    """
+    tokens = []
+    for index, part in enumerate(_VAR_RE.split(template)):
+        if index % 2 == 0: # Even indices are literal text, odd ones are captured variable names
+            if part:
+                tokens.append((part, None))
+        else:
+            tokens.append((None, part))
+    return tokens
+
+
+# --- Helpers for fetching and extracting activity content ---
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    """
+    Returns a requests.Session so repeated fetches reuse pooled keep-alive connections.
+    st.cache_resource keeps one instance across reruns, shared by every browser session and its thread.
+    It therefore rejects all cookies (so no user's cookies reach another's requests) and is never
+    modified after creation; the underlying urllib3 connection pool is thread-safe.
+    """
+    import requests # Imported lazily to keep app start-up fast
+    session = requests.Session()
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    session.headers.update({"Accept": "application/json"})
+    return session
+
+
+def _fetch_bytes(content_url, cached_entry=None):
+    """
+    Downloads content_url and returns (body_bytes, etag, last_modified).
+    If cached_entry has an ETag/Last-Modified validator, a conditional GET is made and a 304 reuses its body.
+    """
+    request_headers = {}
+    if cached_entry is not None:
+        if cached_entry["etag"]:
+            request_headers["If-None-Match"] = cached_entry["etag"]
+        if cached_entry["last_modified"]:
+            request_headers["If-Modified-Since"] = cached_entry["last_modified"]
+    response = _http_session().get(content_url, headers=request_headers, timeout=10) # 10-second timeout
+    if response.status_code == 304 and cached_entry is not None: # Not modified, reuse the cached body
+        return cached_entry["body"], cached_entry["etag"], cached_entry["last_modified"]
+    response.raise_for_status()  # Raise an exception for HTTP errors (4xx or 5xx)
+    return response.content, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+
+def _walk(node, path):
+    """
+    Follows path through parsed JSON and returns the values it reaches.
+    A key or index selects a child, "*" fans out over a list and a (key, value) tuple keeps
+    only dicts whose key equals value. Branches that don't match the expected shape are dropped.
+    """
+    nodes = [node]
+    for step in path:
+        next_nodes = []
+        for current in nodes:
+            if step == "*":
+                if isinstance(current, list):
+                    next_nodes.extend(current)
+            elif isinstance(step, tuple):
+                if isinstance(current, dict) and current.get(step[0]) == step[1]:
+                    next_nodes.append(current)
+            else:
+                try:
+                    next_nodes.append(current[step])
+                except (KeyError, IndexError, TypeError):
+                    pass
+        nodes = next_nodes
+    return nodes
+
+
+# --- Reducers turning the values matched by _walk into a variable value ---
+def _texts(values):
+    return [str(value) for value in values if value]
+
+
+def _first_text(values):
+    texts = _texts(values)
+    return texts[0] if texts else ""
+
+
+def _join_commas(values):
+    return ", ".join(_texts(values))
+
+
+def _join_bullets(values):
+    texts = _texts(values)
+    return "- " + "\n- ".join(texts) if texts else ""
+
+
+def _last_reference(contents_list):
+    # The last matching screen wins, even when its reference is empty or missing
+    for contents in reversed(contents_list):
+        if isinstance(contents, dict):
+            return str(contents.get('reference') or "")
+    return ""
+
+
+# --- Declarative spec for extracting variable values from the activity JSON ---
+# Each entry is (variable name, path for _walk, reducer turning the matched values into the variable's value).
+_EXTRACTION_SPEC = [
+    ("task_instruction", ("interactions", 0, "instruction"), _first_text),
+    ("vocabulary_list", ("referenceScreens", "*", ("category", "vocabulary"), "contents", "vocabularyList", "*"), _join_commas),
+    ("grammar_reference", ("referenceScreens", "*", ("category", "grammar"), "contents"), _last_reference),
+    ("communication_reference", ("referenceScreens", "*", ("category", "communication"), "contents"), _last_reference),
+    ("guiding_questions", ("secondaryScreens", "*", "contents", "*", "secondaryContent"), _join_bullets),
+    ("can_do_statements", ("interactions", 0, "canDoStatement", "*", "statement"), _join_bullets),
+]
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _extract_fields(raw_bytes):
+    """
+    Parses the activity JSON and extracts the predefined variable values using _EXTRACTION_SPEC.
+    Returns (values, warnings). st.cache_data keeps results across reruns and hands out a fresh copy on each call.
+    """
+    activity_data = json.loads(raw_bytes) # Accepts bytes and detects UTF-8/16/32 like response.json()
+
+    warnings = []
+    interactions = activity_data.get('interactions')
+    if not (isinstance(interactions, list) and interactions):
+        warnings.append("Could not find 'interactions' array or it's empty/invalid in the JSON response.")
+    for array_key in ("referenceScreens", "secondaryScreens"):
+        if not isinstance(activity_data.get(array_key, []), list):
+            warnings.append(f"Could not find '{array_key}' array in the JSON response or it's not a list.")
+
+    values = {var_name: reducer(_walk(activity_data, path)) for var_name, path, reducer in _EXTRACTION_SPEC}
+    return values, tuple(warnings)
+
 
 # --- Function to fetch data from URL and populate variables ---
 def fetch_and_populate_variables_action(content_url):
@@ -22,6 +176,8 @@ def fetch_and_populate_variables_action(content_url):
     Fetches data from content_url, parses the JSON, extracts relevant fields,
     and populates the predefined variable input fields in the UI.
     """
+    import requests # Imported lazily to keep app start-up fast; needed for its exception types
+
     # Reset or initialize fetched_variable_values in session state
     st.session_state.fetched_variable_values = {var: "" for var in PREDEFINED_VARIABLES} 
 
@@ -29,86 +185,46 @@ def fetch_and_populate_variables_action(content_url):
         st.warning("Please enter a Content URL to fetch variables.")
         return False
 
-    st.info(f"Fetching data from: {content_url}...")
     try:
-        response = requests.get(content_url, timeout=10) # 10-second timeout
-        response.raise_for_status()  # Raise an exception for HTTP errors (4xx or 5xx)
-        activity_data = response.json()
-
-        # Initialize local variables for extracted data
-        task_instruction_val = ""
-        vocabulary_list_str = ""
-        grammar_reference_val = ""
-        communication_reference_val = ""
-        guiding_questions_val = ""
-        can_do_statements_val = ""
-
-        # Extract from interactions (for task_instruction and can_do_statements)
-        interactions = activity_data.get('interactions', [])
-        if interactions and isinstance(interactions, list) and len(interactions) > 0:
-            interaction = interactions[0] 
-            if isinstance(interaction, dict):
-                task_instruction_val = interaction.get('instruction', '')
-                
-                can_do_statement_list_raw = interaction.get('canDoStatement', [])
-                if isinstance(can_do_statement_list_raw, list):
-                    can_do_statement_list = [
-                        stmt.get('statement', '') 
-                        for stmt in can_do_statement_list_raw if isinstance(stmt, dict) and stmt.get('statement')
-                    ]
-                    can_do_statements_val = "\n".join(f"- {s}" for s in can_do_statement_list)
-        else:
-            st.warning("Could not find 'interactions' array or it's empty/invalid in the JSON response.")
-
-        # Extract from referenceScreens
-        reference_screens = activity_data.get('referenceScreens', [])
-        if isinstance(reference_screens, list):
-            vocabulary_items_list = [] 
-            for ref in reference_screens:
-                if isinstance(ref, dict):
-                    category = ref.get('category')
-                    contents = ref.get('contents')
-                    if isinstance(contents, dict):
-                        if category == 'vocabulary':
-                            vocab_list_from_json = contents.get('vocabularyList', [])
-                            if isinstance(vocab_list_from_json, list):
-                                vocabulary_items_list.extend(str(item) for item in vocab_list_from_json if item)
-                        elif category == 'grammar':
-                            grammar_reference_val = contents.get('reference', '')
-                        elif category == 'communication':
-                            communication_reference_val = contents.get('reference', '')
-            if vocabulary_items_list:
-                vocabulary_list_str = ', '.join(vocabulary_items_list)
-        else:
-            st.warning("Could not find 'referenceScreens' array in the JSON response or it's not a list.")
-
-        # Extract from secondaryScreens (for guiding_questions)
-        secondary_screens = activity_data.get('secondaryScreens', [])
-        if isinstance(secondary_screens, list):
-            guiding_questions_list_raw = []
-            for screen in secondary_screens:
-                if isinstance(screen, dict):
-                    secondary_content_items = screen.get('contents', [])
-                    if isinstance(secondary_content_items, list):
-                        for item in secondary_content_items:
-                            if isinstance(item, dict):
-                                question_text = item.get('secondaryContent')
-                                if question_text: 
-                                    guiding_questions_list_raw.append(str(question_text))
-            if guiding_questions_list_raw:
-                guiding_questions_val = "\n".join(f"- {q}" for q in guiding_questions_list_raw)
+        # Reuse a body downloaded for this URL in the last FETCH_CACHE_TTL_SECONDS.
+        # Entries with an ETag/Last-Modified validator are always revalidated with a conditional GET instead.
+        fetch_cache = st.session_state.fetch_cache
+        cached_entry = fetch_cache.get(content_url)
+        use_cached_body = (
+            cached_entry is not None
+            and not (cached_entry["etag"] or cached_entry["last_modified"])
+            and time.monotonic() - cached_entry["fetched_at"] < FETCH_CACHE_TTL_SECONDS
+        )
+        if use_cached_body:
+            fetch_cache.move_to_end(content_url)
+            raw_bytes = cached_entry["body"]
         else:
-            st.warning("Could not find 'secondaryScreens' array in the JSON response or it's not a list.")
+            st.info(f"Fetching data from: {content_url}...")
+            raw_bytes, etag, last_modified = _fetch_bytes(content_url, cached_entry)
+
+        extracted_values, extraction_warnings = _extract_fields(raw_bytes)
+        for warning_message in extraction_warnings:
+            st.warning(warning_message)
+
+        # Only cache bodies that parsed successfully
+        if not use_cached_body:
+            fetch_cache[content_url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "body": raw_bytes,
+                "fetched_at": time.monotonic(),
+            }
+            fetch_cache.move_to_end(content_url)
+            while len(fetch_cache) > FETCH_CACHE_MAX_ENTRIES:
+                fetch_cache.popitem(last=False) # Evict the least recently used URL
 
         # Populate session state with extracted values
-        st.session_state.fetched_variable_values['task_instruction'] = task_instruction_val
-        st.session_state.fetched_variable_values['vocabulary_list'] = vocabulary_list_str
-        st.session_state.fetched_variable_values['grammar_reference'] = grammar_reference_val
-        st.session_state.fetched_variable_values['communication_reference'] = communication_reference_val
-        st.session_state.fetched_variable_values['guiding_questions'] = guiding_questions_val
-        st.session_state.fetched_variable_values['can_do_statements'] = can_do_statements_val
+        st.session_state.fetched_variable_values.update(extracted_values)
         
-        st.success("Successfully fetched and processed data from URL.")
+        if use_cached_body:
+            st.success("Loaded data for this URL from the session cache.")
+        else:
+            st.success("Successfully fetched and processed data from URL.")
         return True
 
     except requests.exceptions.RequestException as e:
@@ -134,61 +250,83 @@ def generate_prompt_action(prompt_template, variable_values_from_fetch, content_
     """
     Processes the inputs to generate the final prompt(s) and displays them.
     """
-    # Initialize a dictionary for all variables that will go into the template
-    all_vars_for_template = {key: variable_values_from_fetch.get(key, "") for key in PREDEFINED_VARIABLES}
+    # Scan the template only when it changed since the last generation (a string compare is far cheaper than the regexes)
+    if st.session_state.scanned_template != prompt_template:
+        st.session_state.template_scan = (
+            _compile_template(prompt_template),
+            frozenset(_PLACEHOLDER_RE.findall(prompt_template)),
+        )
+        st.session_state.scanned_template = prompt_template
+    template_tokens, template_vars_in_use = st.session_state.template_scan
+
+    # Only variables that actually appear in the template need a value
+    needed_vars = {var_name for _, var_name in template_tokens if var_name is not None}
+
+    # Initialize a dictionary for the variables that will go into the template
+    # Values are stringified once here and the dict is shared by every render (no per-answer copies)
+    all_vars_for_template = {
+        key: str(variable_values_from_fetch.get(key, "")) for key in needed_vars if key != "student_answer"
+    }
 
     # Check for non-allowed variables in the template early
-    template_vars_in_use = set(re.findall(r"\{\{(.*?)\}\}", prompt_template))
-    allowed_vars_set = set(ALL_POSSIBLE_VARIABLES)
-    non_allowed_vars = template_vars_in_use - allowed_vars_set
+    non_allowed_vars = template_vars_in_use - ALLOWED_VARIABLES
     if non_allowed_vars:
         st.warning(f"Warning: The template uses variables not in the predefined list: {', '.join(non_allowed_vars)}")
 
-    final_prompts_generated_data = [] # To store data for potential CSV download
+    generated_prompt_count = 0
 
     if answers_method == "Text Box (for a single answer)":
         current_student_answer = answers_input if answers_input else ""
-        if not current_student_answer and "student_answer" in template_vars_in_use:
+        if not current_student_answer and "student_answer" in needed_vars:
             st.info("Note: 'student_answer' is in the template, but no answer was provided in the text box.")
         
-        all_vars_for_template["student_answer"] = current_student_answer
+        all_vars_for_template["student_answer"] = str(current_student_answer)
         
-        final_prompt = prompt_template
-        for var_key, var_value in all_vars_for_template.items():
-            if var_key in ALL_POSSIBLE_VARIABLES: # Ensure we only try to replace allowed variables
-                final_prompt = final_prompt.replace(f"{{{{{var_key}}}}}", str(var_value))
+        final_prompt = "".join(
+            literal if var_name is None else all_vars_for_template[var_name] for literal, var_name in template_tokens
+        )
         
         st.markdown("#### Generated Prompt (with Text Box Answer):")
         st.code(final_prompt, language='text')
-        final_prompts_generated_data.append({
-            # "original_student_answer": current_student_answer, 
-            "generated_prompt": final_prompt
-        })
+        generated_prompt_count = 1
 
     elif answers_method == "Upload CSV (for multiple answers)":
         if answers_input and isinstance(answers_input, list):
+            import pandas as pd # Imported lazily so the text box path never pays for it
+
             st.markdown(f"#### Generating Prompts for {len(answers_input)} Answers from CSV:")
             
-            for student_answer_from_csv in answers_input:
-                # Create a fresh copy of variables for each row to avoid modification issues
-                current_row_vars = all_vars_for_template.copy()
-                current_row_vars["student_answer"] = student_answer_from_csv
-
-                current_filled_prompt = prompt_template
-                for var_key, var_value in current_row_vars.items():
-                    if var_key in ALL_POSSIBLE_VARIABLES:
-                        current_filled_prompt = current_filled_prompt.replace(f"{{{{{var_key}}}}}", str(var_value))
-                
-                final_prompts_generated_data.append({
-                    # "original_student_answer": student_answer_from_csv,
-                    "generated_prompt": current_filled_prompt
-                })
+            # Pre-fill everything except student_answer
+            fixed_parts = [
+                literal if var_name is None
+                else _STUDENT_ANSWER_SLOT if var_name == "student_answer"
+                else all_vars_for_template[var_name]
+                for literal, var_name in template_tokens
+            ]
+            answers_series = pd.Series(answers_input, dtype=object).astype(str)
+            slot_positions = [index for index, part in enumerate(fixed_parts) if part is _STUDENT_ANSWER_SLOT]
+            if len(slot_positions) == 1:
+                # Common case: a single {{student_answer}} slot, so every prompt is prefix + answer + suffix
+                prefix = "".join(fixed_parts[:slot_positions[0]])
+                suffix = "".join(fixed_parts[slot_positions[0] + 1:])
+                generated_prompts = prefix + answers_series + suffix
+            else:
+                generated_prompts = answers_series.map(
+                    lambda answer: "".join(answer if part is _STUDENT_ANSWER_SLOT else part for part in fixed_parts)
+                )
+            results_df = pd.DataFrame({"generated_prompt": generated_prompts})
+            generated_prompt_count = len(results_df)
             
-            if final_prompts_generated_data:
-                results_df = pd.DataFrame(final_prompts_generated_data)
-                st.dataframe(results_df, use_container_width=True)
+            if generated_prompt_count:
+                # Only preview the first rows; serializing every (multi-kB) prompt to the browser is costly
+                st.dataframe(results_df.head(PREVIEW_ROW_LIMIT), use_container_width=True, hide_index=True)
+                if generated_prompt_count > PREVIEW_ROW_LIMIT:
+                    st.caption(f"Showing the first {PREVIEW_ROW_LIMIT} of {generated_prompt_count} prompts. Download the CSV for all of them.")
                 
-                csv_output = results_df.to_csv(index=False).encode('utf-8')
+                # Write straight to a bytes buffer instead of building a str and encoding it
+                csv_buffer = io.BytesIO()
+                results_df.to_csv(csv_buffer, index=False, encoding='utf-8')
+                csv_output = csv_buffer.getvalue()
                 st.download_button(
                     label="Download Generated Prompts as CSV",
                     data=csv_output,
@@ -203,7 +341,7 @@ def generate_prompt_action(prompt_template, variable_values_from_fetch, content_
     else:
         st.error("Invalid answer method selected or no answers provided for processing.") # Should ideally not happen
 
-    if not final_prompts_generated_data:
+    if not generated_prompt_count:
         st.info("No prompts were generated. Check inputs and template.")
     
     st.success("🚀 Prompt processing complete! Review generated prompts above. 🚀")
@@ -281,6 +419,11 @@ Just give your feedback and end your response.
         st.session_state.content_url = "" 
     if 'fetched_variable_values' not in st.session_state:
         st.session_state.fetched_variable_values = {var: "" for var in PREDEFINED_VARIABLES}
+    if 'fetch_cache' not in st.session_state:
+        st.session_state.fetch_cache = OrderedDict() # Content URL -> downloaded body and its validators, in LRU order
+    if 'scanned_template' not in st.session_state:
+        st.session_state.scanned_template = None # Template that template_scan was computed from
+        st.session_state.template_scan = None # (tokens, placeholder names) for scanned_template
     if 'answer_input_method' not in st.session_state:
         st.session_state.answer_input_method = "Text Box (for a single answer)"
     if 'single_answer' not in st.session_state:
@@ -337,14 +480,16 @@ Just give your feedback and end your response.
         for var_name in PREDEFINED_VARIABLES:
             # Read current value from session_state to display
             current_var_value = st.session_state.fetched_variable_values.get(var_name, "")
-            # Update session_state directly as user types due to the key
-            st.session_state.fetched_variable_values[var_name] = st.text_area(
+            new_var_value = st.text_area(
                 f"`{var_name}`:",
                 value=current_var_value,
                 key=f"fetched_var_input_{var_name}", # Unique key for each text area
                 height=100, 
                 help=f"Value for {var_name}. Fetched from URL or manually entered."
             )
+            # Only write back to session_state when the user actually changed the value
+            if new_var_value != current_var_value:
+                st.session_state.fetched_variable_values[var_name] = new_var_value
     st.markdown("---")
 
     # --- 3. Student Answer Input ---
@@ -393,7 +538,11 @@ Just give your feedback and end your response.
             if uploaded_file.name != st.session_state.get('last_uploaded_filename', None):
                 st.session_state.last_uploaded_filename = uploaded_file.name
                 try:
-                    df = pd.read_csv(uploaded_file)
+                    import pandas as pd # Imported lazily so the text box path never pays for it
+
+                    # Only parse the Answers column, as text, to skip type inference on unused columns.
+                    # A callable usecols leaves df without the column (instead of raising) when it is missing.
+                    df = pd.read_csv(uploaded_file, usecols=lambda column: column == "Answers", dtype={"Answers": str})
                     if "Answers" in df.columns:
                         st.session_state.uploaded_csv_answers = df["Answers"].astype(str).tolist()
                         st.success(f"Successfully read {len(st.session_state.uploaded_csv_answers)} answers from '{uploaded_file.name}'.")
@@ -441,8 +590,7 @@ Just give your feedback and end your response.
             if st.session_state.fetched_variable_values:
                 # Ensure all predefined keys exist for display, even if empty
                 display_vars = {key: st.session_state.fetched_variable_values.get(key, "") for key in PREDEFINED_VARIABLES}
-                vars_df = pd.DataFrame(display_vars.items(), columns=['Variable', 'Value'])
-                st.table(vars_df)
+                st.json(display_vars) # A handful of values; no need for a DataFrame round trip
             else:
                 st.info("No variables were fetched/used from the content URL section.")
 